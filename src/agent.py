@@ -1,34 +1,63 @@
 import os
 import logging
 import argparse
+import multiprocessing
+import queue
 import shutil
 import signal
+import socket
 import sys
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
+from datetime import datetime
 
 import restful_api
 import app_state
 from src.tools.scrubber import SensitiveDataFilter
-from tools import git, terraform, colors
+from tools import git, terraform, colors, tracing, datadog, parallelism, resources, cluster as cluster_tools
 from configuration import load_config, AppConfig, Deployment
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
-from prometheus_client import Gauge
+from prometheus_client import Gauge, Histogram
 
 
 def signal_handler(sig, frame):
     print("Signal received, shutting down...")
     scheduler.shutdown()
+    if cluster is not None:
+        cluster.leave()
+    if state.dogstatsd is not None:
+        state.dogstatsd.close()
+    if check_executor is not None:
+        check_executor.shutdown(wait=False, cancel_futures=True)
+    if plan_decoder is not None:
+        plan_decoder.shutdown(cancel_futures=True)
     sys.exit(0)
 
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+CLUSTER_HEARTBEAT_JOB_ID = "__cluster_heartbeat__"
+CLUSTER_HEARTBEAT_EXECUTOR = "cluster_heartbeat"
 
 scheduler = BackgroundScheduler()
 state = app_state.ApplicationState()
+cluster: cluster_tools.ClusterMembership | None = None
+tracer = tracing.Tracer()
+parallelism_controller: parallelism.AdaptiveParallelismController | None = None
+parallelism_budget: parallelism.ParallelismBudget | None = None
+provider_log_level: str | None = None
+resource_profiles = resources.ResourceProfiles(default_memory_bytes=1024 * 1024 * 1024)
+admission_controller: resources.MemoryAdmissionController | None = None
+check_executor: ThreadPoolExecutor | None = None
+check_slots: threading.BoundedSemaphore | None = None
+admission_queue: queue.Queue = queue.Queue()
+queued_checks: set[str] = set()
+queued_checks_lock = threading.Lock()
+plan_decoder: terraform.PlanDecoder | None = None
+sharded_plan_runs: dict[str, int] = {}
 
 state.set_gauge("drift_monitor_agent_drift_detected_changes", Gauge('drift_monitor_agent_drift_detected_changes',
                                                                     'Number of drift detected changes',
@@ -42,22 +71,83 @@ state.set_gauge("drift_monitor_agent_drift_check_error", Gauge('drift_monitor_ag
 state.set_gauge("drift_monitor_agent_drift_check_duration", Gauge('drift_monitor_agent_drift_check_duration',
                                                                   'Duration of drift checks',
                                                                   labelnames=['name', 'phase']))
+state.set_histogram("drift_monitor_agent_drift_check_phase_duration_seconds",
+                    Histogram('drift_monitor_agent_drift_check_phase_duration_seconds',
+                              'Duration of drift check phases',
+                              labelnames=['name', 'phase'],
+                              buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, float("inf"))))
+state.set_gauge("drift_monitor_agent_terraform_parallelism", Gauge('drift_monitor_agent_terraform_parallelism',
+                                                                   'Parallelism of the last terraform plan',
+                                                                   labelnames=['name']))
+state.set_gauge("drift_monitor_agent_drift_check_cpu_seconds", Gauge('drift_monitor_agent_drift_check_cpu_seconds',
+                                                                     'CPU time used by the subprocesses of the last drift check',
+                                                                     labelnames=['name']))
+state.set_gauge("drift_monitor_agent_drift_check_peak_memory_bytes", Gauge('drift_monitor_agent_drift_check_peak_memory_bytes',
+                                                                           'Peak RSS of the subprocesses of the last drift check',
+                                                                           labelnames=['name']))
+state.set_gauge("drift_monitor_agent_drift_check_io_bytes", Gauge('drift_monitor_agent_drift_check_io_bytes',
+                                                                  'Bytes read and written by the subprocesses of the last drift check',
+                                                                  labelnames=['name', 'direction']))
+state.set_gauge("drift_monitor_agent_drift_check_predicted_memory_bytes", Gauge('drift_monitor_agent_drift_check_predicted_memory_bytes',
+                                                                                'Memory predicted for the next drift check',
+                                                                                labelnames=['name']))
 
 
 def load_jobs(config: AppConfig):
     deployments = config.infrastructure_deployments
 
-    # Clear all existing jobs
-    scheduler.remove_all_jobs()
+    # Clear all existing deployment jobs, the cluster heartbeat job is kept
+    for job in scheduler.get_jobs():
+        if job.id != CLUSTER_HEARTBEAT_JOB_ID:
+            job.remove()
 
     # Add new jobs
     for deployment in deployments:
+        if cluster is not None and not cluster.owns(deployment.name):
+            logging.info(f"Skipping deployment \"{deployment.name}\" owned by replica \"{cluster.get_owner(deployment.name)}\"")
+            state.delete_deployment_state(deployment.name)
+            continue
         logging.info(f"Adding job for deployment \"{deployment.name}\"")
         deployment.active_apscheduler_job = scheduler.add_job(infrastructure_deployment_drift_check,
                                                               'interval', minutes=deployment.drift_check_interval,
                                                               args=[deployment, state], id=deployment.name)
 
 
+def rebalance_jobs(config: AppConfig):
+    # Only touch the jobs whose ownership changed, so that the deployments we keep are not rescheduled
+    for deployment in config.infrastructure_deployments:
+        job = scheduler.get_job(deployment.name)
+        if cluster.owns(deployment.name):
+            if job is None:
+                logging.info(f"Taking over deployment \"{deployment.name}\"")
+                deployment.active_apscheduler_job = scheduler.add_job(infrastructure_deployment_drift_check,
+                                                                      'interval', minutes=deployment.drift_check_interval,
+                                                                      args=[deployment, state], id=deployment.name,
+                                                                      next_run_time=datetime.now())
+        elif job is not None:
+            logging.info(f"Handing over deployment \"{deployment.name}\" to replica \"{cluster.get_owner(deployment.name)}\"")
+            job.remove()
+            deployment.active_apscheduler_job = None
+            state.delete_deployment_state(deployment.name)
+
+
+def cluster_heartbeat(config: AppConfig):
+    try:
+        if cluster.heartbeat():
+            rebalance_jobs(config)
+    except Exception as e:
+        logging.error(f"Error renewing cluster lease: {e}")
+
+
+def setup_cluster(config: AppConfig) -> cluster_tools.ClusterMembership:
+    replica_id = config.cluster.replica_id or socket.gethostname()
+    address = config.cluster.advertise_url or f"http://{socket.getfqdn()}:{config.server.port}"
+    store = cluster_tools.create_lease_store(config.cluster.lease_store, config.cluster.lease_store_path)
+    logging.info(f"Joining cluster as replica \"{replica_id}\" reachable at {address}")
+    return cluster_tools.ClusterMembership(store, replica_id, address, lease_ttl=config.cluster.lease_ttl,
+                                           virtual_nodes=config.cluster.virtual_nodes)
+
+
 def reload_config(args: argparse.Namespace) -> AppConfig | None:
     logger = logging.getLogger(__name__)
 
@@ -82,79 +172,252 @@ def reload_deployments(args: argparse.Namespace):
 debug__previous_directory = None
 
 
-def infrastructure_deployment_drift_check(deployment: Deployment, state: app_state.ApplicationState):
-    global_start_time: float
-    local_start_time: float
+def publish_deployment_state(deployment: Deployment, deployment_state: app_state.DeploymentState):
+    # The deployment may have been handed over to another replica while the check was running, publishing its result
+    # here would leave a stale duplicate of the state served by the new owner
+    if cluster is not None and not cluster.owns(deployment.name):
+        logging.info(f"Not publishing the state of deployment \"{deployment.name}\", it is now owned by replica "
+                     f"\"{cluster.get_owner(deployment.name)}\"")
+        return
+    state.set_deployment_state(deployment.name, state=deployment_state)
+
+
+def observe_phase_duration(deployment: Deployment, phase: str, duration: float,
+                           check_span: tracing.Span | None = None, end_time: float | None = None):
+    state.observe_histogram_value("drift_monitor_agent_drift_check_phase_duration_seconds",
+                                  {"name": deployment.name, "phase": phase}, duration, tags=deployment.tags)
+    if check_span is not None:
+        end_time = end_time if end_time is not None else time.time()
+        tracer.record_span(phase, end_time - duration, end_time, parent=check_span,
+                           attributes={"deployment.name": deployment.name})
+
+
+def plan_deployment(deployment: Deployment, directory: str, target_dir: str, stats: terraform.PlanRunStats,
+                    parallelism: int | None = None) -> tuple[bool, terraform.TerraformPlan]:
+    if deployment.sharding and deployment.sharding.get('shards', 1) > 1:
+        # Every `full_plan_every` runs, starting with the first one, a full plan catches whatever the targets of the
+        # sharded plans might miss
+        runs = sharded_plan_runs.get(deployment.name, 0)
+        sharded_plan_runs[deployment.name] = runs + 1
+        full_plan_every = deployment.sharding.get('full_plan_every', 10)
+        if full_plan_every > 0 and runs % full_plan_every == 0:
+            return terraform.init_and_plan(target_dir, env_variables=deployment.env_vars, display_colors=True,
+                                           stats=stats, parallelism=parallelism, plan_decoder=plan_decoder,
+                                           provider_log_level=provider_log_level)
+
+        previous_state = state.get_deployment_state(deployment.name)
+        return terraform.sharded_init_and_plan(target_dir, deployment.sharding['shards'], copy_root=directory,
+                                               env_variables=deployment.env_vars, display_colors=True, stats=stats,
+                                               parallelism=parallelism,
+                                               previous_plan=previous_state.plan if previous_state else None,
+                                               timeout=deployment.sharding.get('timeout'),
+                                               plan_decoder=plan_decoder, provider_log_level=provider_log_level)
+
+    return terraform.init_and_plan(target_dir, env_variables=deployment.env_vars, display_colors=True, stats=stats,
+                                   parallelism=parallelism, plan_decoder=plan_decoder,
+                                   provider_log_level=provider_log_level)
+
 
+def infrastructure_deployment_drift_check(deployment: Deployment, state: app_state.ApplicationState):
     logger = logging.getLogger(__name__)
 
     if not deployment.enabled:
         logger.info(f"Skipping deployment \"{deployment.name}\" because it is disabled")
         return
 
+    # The scheduler threads only queue the check, the admission thread waits for room to run it
+    with queued_checks_lock:
+        if deployment.name in queued_checks:
+            logger.warning(f"Skipping drift check of deployment \"{deployment.name}\", the previous one is still "
+                           f"waiting or running")
+            return
+        queued_checks.add(deployment.name)
+    admission_queue.put((deployment, state, time.time()))
+
+
+def start_check_runner(max_concurrent_checks: int):
+    global check_executor, check_slots
+    check_executor = ThreadPoolExecutor(max_workers=max_concurrent_checks, thread_name_prefix="drift_check")
+    check_slots = threading.BoundedSemaphore(max_concurrent_checks)
+    threading.Thread(target=admit_drift_checks, name="drift_check_admission", daemon=True).start()
+
+
+def admit_drift_checks():
+    logger = logging.getLogger(__name__)
+
+    # Checks are admitted one after the other in the order they were queued. A check waits for a free check thread,
+    # then for the memory it is predicted to need to fit in the budget, and is skipped if it does not get both before
+    # its next run is due. Waiting checks hold no thread of the check executor
+    while True:
+        deployment, state, queued_time = admission_queue.get()
+        deadline = queued_time + deployment.drift_check_interval * 60
+        predicted_memory = resource_profiles.predict_memory(deployment.name)
+
+        if not check_slots.acquire(timeout=max(0.0, deadline - time.time())):
+            logger.warning(f"Skipping drift check of deployment \"{deployment.name}\", no check thread was free "
+                           f"before its next run")
+            with queued_checks_lock:
+                queued_checks.discard(deployment.name)
+            continue
+        if admission_controller is not None and \
+                not admission_controller.acquire(predicted_memory, timeout=max(0.0, deadline - time.time())):
+            logger.warning(f"Skipping drift check of deployment \"{deployment.name}\", its predicted memory of "
+                           f"{predicted_memory} bytes did not fit in the memory budget")
+            check_slots.release()
+            with queued_checks_lock:
+                queued_checks.discard(deployment.name)
+            continue
+
+        observe_phase_duration(deployment, "admission_wait", time.time() - queued_time)
+        check_executor.submit(run_admitted_drift_check, deployment, state, predicted_memory)
+
+
+def run_admitted_drift_check(deployment: Deployment, state: app_state.ApplicationState, predicted_memory: int):
+    logger = logging.getLogger(__name__)
+
+    stats = terraform.PlanRunStats()
+    try:
+        with tracer.start_span("drift_check", attributes={"deployment.name": deployment.name}) as check_span:
+            run_drift_check(deployment, state, check_span, stats)
+            observe_phase_duration(deployment, "total",
+                                   (time.time_ns() - check_span.start_time_unix_nano) / 1e9)
+    except Exception as e:
+        logger.error(f"Error running drift check of deployment \"{deployment.name}\": {e}")
+        traceback.print_exception(e)
+    finally:
+        if admission_controller is not None:
+            admission_controller.release(predicted_memory)
+        check_slots.release()
+        with queued_checks_lock:
+            queued_checks.discard(deployment.name)
+        record_check_resources(deployment, stats)
+
+
+def record_check_resources(deployment: Deployment, stats: terraform.PlanRunStats):
+    logger = logging.getLogger(__name__)
+
+    for usage in stats.process_usages:
+        logger.debug(f"Resources used by deployment \"{deployment.name}\": {usage}")
+
+    # A check that failed before running terraform says nothing about the memory it needs
+    if stats.peak_rss_bytes > 0:
+        resource_profiles.record(deployment.name, stats.peak_rss_bytes)
+
+    state.set_gauge_value("drift_monitor_agent_drift_check_cpu_seconds", {"name": deployment.name},
+                          sum(usage.cpu_time for usage in stats.process_usages), tags=deployment.tags)
+    state.set_gauge_value("drift_monitor_agent_drift_check_peak_memory_bytes", {"name": deployment.name},
+                          stats.peak_rss_bytes, tags=deployment.tags)
+    state.set_gauge_value("drift_monitor_agent_drift_check_io_bytes", {"name": deployment.name, "direction": "read"},
+                          sum(usage.read_bytes for usage in stats.process_usages), tags=deployment.tags)
+    state.set_gauge_value("drift_monitor_agent_drift_check_io_bytes", {"name": deployment.name, "direction": "write"},
+                          sum(usage.write_bytes for usage in stats.process_usages), tags=deployment.tags)
+    state.set_gauge_value("drift_monitor_agent_drift_check_predicted_memory_bytes", {"name": deployment.name},
+                          resource_profiles.predict_memory(deployment.name), tags=deployment.tags)
+
+
+def run_drift_check(deployment: Deployment, state: app_state.ApplicationState, check_span: tracing.Span,
+                    stats: terraform.PlanRunStats):
+    global_start_time: float
+    local_start_time: float
+
+    logger = logging.getLogger(__name__)
+
     global_start_time = time.time()
 
     local_start_time = time.time()
     try:
         logger.info(f"Processing deployment \"{deployment.name}\"")
+        # The clone is left out of the resources of the check: GitPython does not expose its git process to `wait4`,
+        # and the process-wide usage of the children would also count the terraform processes of the other checks
         directory = git.shallow_clone_repo(deployment.git['repo_url'], branch=deployment.git['branch'],
                                            ssh_private_key_path=deployment.git['ssh_key'])
     except Exception as e:
-        state.set_deployment_state(deployment.name, state=app_state.DeploymentState(deployment.name, success=False))
+        publish_deployment_state(deployment, app_state.DeploymentState(deployment.name, success=False))
 
-        state.get_gauge("drift_monitor_agent_drift_check_success").labels(deployment.name).set(0)
-        state.get_gauge("drift_monitor_agent_drift_check_error").labels(deployment.name).set(1)
-        state.get_gauge("drift_monitor_agent_drift_check_duration").labels(deployment.name, "git_clone").set(
-            time.time() - local_start_time)
+        state.set_gauge_value("drift_monitor_agent_drift_check_success", {"name": deployment.name}, 0, tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_error", {"name": deployment.name}, 1, tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_duration", {"name": deployment.name, "phase": "git_clone"},
+            time.time() - local_start_time, tags=deployment.tags)
+        observe_phase_duration(deployment, "git_clone", time.time() - local_start_time, check_span)
+        check_span.set_error(e)
 
         logging.error(f"Error cloning repository {deployment.git['repo_url']}: {e}")
         traceback.print_exception(e)
         return
 
-    state.get_gauge("drift_monitor_agent_drift_check_duration").labels(deployment.name, "git_clone").set(
-        time.time() - local_start_time)
+    state.set_gauge_value("drift_monitor_agent_drift_check_duration", {"name": deployment.name, "phase": "git_clone"},
+        time.time() - local_start_time, tags=deployment.tags)
+    observe_phase_duration(deployment, "git_clone", time.time() - local_start_time, check_span)
 
     local_start_time = time.time()
     try:
         target_dir = os.path.join(directory, deployment.source_root)
 
-        is_different, plan = terraform.init_and_plan(target_dir, env_variables=deployment.env_vars,
-                                                     display_colors=True)
-
+        if parallelism_controller is not None:
+            account = deployment.cloud_account or (deployment.env_vars or {}).get('AWS_PROFILE') or deployment.name
+            with parallelism_budget.reserve(account, parallelism_controller.get(deployment.name)) as plan_parallelism:
+                state.set_gauge_value("drift_monitor_agent_terraform_parallelism", {"name": deployment.name},
+                                      plan_parallelism, tags=deployment.tags)
+                is_different, plan = plan_deployment(deployment, directory, target_dir, stats,
+                                                     parallelism=plan_parallelism)
+        else:
+            is_different, plan = plan_deployment(deployment, directory, target_dir, stats)
+
+        publish_start_time = time.time()
         deployment_state = app_state.DeploymentState(deployment.name, is_different, plan=plan)
-        state.set_deployment_state(deployment.name, state=deployment_state)
+        publish_deployment_state(deployment, deployment_state)
 
         logging.debug(f"Deployment plan drift resources count for \"{deployment.name}\": {plan.count_resources_except_noop_and_read()}")
-        state.get_gauge("drift_monitor_agent_drift_detected_changes").labels(deployment.name).set(plan.count_resources_except_noop_and_read())
-        state.get_gauge("drift_monitor_agent_drift_check_success").labels(deployment.name).set(1)
-        state.get_gauge("drift_monitor_agent_drift_check_error").labels(deployment.name).set(0)
-        state.get_gauge("drift_monitor_agent_drift_check_duration").labels(deployment.name, "total").set(
-            time.time() - global_start_time)
+        state.set_gauge_value("drift_monitor_agent_drift_detected_changes", {"name": deployment.name}, plan.count_resources_except_noop_and_read(), tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_success", {"name": deployment.name}, 1, tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_error", {"name": deployment.name}, 0, tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_duration", {"name": deployment.name, "phase": "total"},
+            time.time() - global_start_time, tags=deployment.tags)
+        observe_phase_duration(deployment, "state_publish", time.time() - publish_start_time, check_span)
+
+        check_span.set_attribute("drift.detected", is_different)
+        check_span.set_attribute("drift.changes", plan.count_resources_except_noop_and_read())
 
         if is_different:
             logger.warning("The plan shows differences between what is defined in the Terraform code and actual infrastructure.")
             logger.warning(f"Breakdown by types of the changes that would be applied: {plan.get_changes_breakdown()}")
 
     except terraform.ConsoleException as e:
-        state.set_deployment_state(deployment.name, state=app_state.DeploymentState(deployment.name, success=False))
-        state.get_gauge("drift_monitor_agent_drift_check_success").labels(deployment.name).set(0)
-        state.get_gauge("drift_monitor_agent_drift_check_error").labels(deployment.name).set(1)
-        state.get_gauge("drift_monitor_agent_drift_check_duration").labels(deployment.name, "total").set(
-            time.time() - global_start_time)
+        publish_deployment_state(deployment, app_state.DeploymentState(deployment.name, success=False))
+        state.set_gauge_value("drift_monitor_agent_drift_check_success", {"name": deployment.name}, 0, tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_error", {"name": deployment.name}, 1, tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_duration", {"name": deployment.name, "phase": "total"},
+            time.time() - global_start_time, tags=deployment.tags)
+        check_span.set_error(e)
         logging.error(e)
         print(colors.ansi_to_html(str(e)))
         return
 
     except Exception as e:
-        state.set_deployment_state(deployment.name, state=app_state.DeploymentState(deployment.name, success=False))
-        state.get_gauge("drift_monitor_agent_drift_check_success").labels(deployment.name).set(0)
-        state.get_gauge("drift_monitor_agent_drift_check_error").labels(deployment.name).set(1)
-        state.get_gauge("drift_monitor_agent_drift_check_duration").labels(deployment.name, "total").set(
-            time.time() - global_start_time)
+        publish_deployment_state(deployment, app_state.DeploymentState(deployment.name, success=False))
+        state.set_gauge_value("drift_monitor_agent_drift_check_success", {"name": deployment.name}, 0, tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_error", {"name": deployment.name}, 1, tags=deployment.tags)
+        state.set_gauge_value("drift_monitor_agent_drift_check_duration", {"name": deployment.name, "phase": "total"},
+            time.time() - global_start_time, tags=deployment.tags)
+        check_span.set_error(e)
         logging.error(e)
         return
 
     finally:
+        # Terraform phases are timed by `init_and_plan`, the ones completed are recorded even if a later one failed.
+        # They are labeled `init`, `plan`, `show` and `parse`, as `terraform_plan` already names init to parse in the
+        # `drift_monitor_agent_drift_check_duration` gauge
+        for phase, (phase_start_time, phase_end_time) in stats.phase_times.items():
+            observe_phase_duration(deployment, phase, phase_end_time - phase_start_time,
+                                   check_span, end_time=phase_end_time)
+
+        # Only learn from plans that succeeded, or that failed because of throttling. The duration of a failed plan
+        # says nothing about the parallelism
+        if parallelism_controller is not None and (stats.plan_succeeded or stats.throttling_events > 0):
+            parallelism_controller.update(deployment.name,
+                                          stats.phase_durations['plan'] if stats.plan_succeeded else None,
+                                          stats.throttling_events, plan_mode=stats.plan_mode)
+
         # # Delete the temporary directory with a twist
         #
         # There is a bug with the GitPython library that makes it so that if you delete the directory that was operated
@@ -171,11 +434,11 @@ def infrastructure_deployment_drift_check(deployment: Deployment, state: app_sta
         except NameError:
             pass
 
-    state.get_gauge("drift_monitor_agent_drift_check_duration").labels(deployment.name, "terraform_plan").set(
-        time.time() - local_start_time)
+    state.set_gauge_value("drift_monitor_agent_drift_check_duration", {"name": deployment.name, "phase": "terraform_plan"},
+        time.time() - local_start_time, tags=deployment.tags)
 
-    state.get_gauge("drift_monitor_agent_drift_check_duration").labels(deployment.name, "total").set(
-        time.time() - global_start_time)
+    state.set_gauge_value("drift_monitor_agent_drift_check_duration", {"name": deployment.name, "phase": "total"},
+        time.time() - global_start_time, tags=deployment.tags)
 
 
 def main():
@@ -192,6 +455,11 @@ def main():
 
     args = parser.parse_args()
 
+    # Registered here rather than at import: the plan decoding workers import this module as `__mp_main__` when they
+    # start, and must keep the default handlers
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
     # Set up logging
     logging.basicConfig(level=args.loglevel)
     logger = logging.getLogger(__name__)
@@ -209,15 +477,75 @@ def main():
         logger.critical(f"Error parsing configuration file: {e}")
         return
 
+    global cluster, tracer, parallelism_controller, parallelism_budget, resource_profiles, admission_controller
+    global plan_decoder, provider_log_level
+
+    state.prometheus_enabled = "prometheus" in config.metrics.backends
+    if "dogstatsd" in config.metrics.backends:
+        dogstatsd_config = config.metrics.dogstatsd
+        logger.info(f"Sending metrics to DogStatsD at {dogstatsd_config.host}:{dogstatsd_config.port}")
+        state.dogstatsd = datadog.DogStatsdClient(host=dogstatsd_config.host, port=dogstatsd_config.port,
+                                                  prefix=dogstatsd_config.prefix,
+                                                  constant_tags=dogstatsd_config.constant_tags,
+                                                  max_packet_size=dogstatsd_config.max_packet_size,
+                                                  flush_interval=dogstatsd_config.flush_interval)
+
+    if config.parallelism.adaptive:
+        parallelism_controller = parallelism.AdaptiveParallelismController(
+            state_file=config.parallelism.state_file, initial=config.parallelism.initial,
+            minimum=config.parallelism.minimum, maximum=config.parallelism.maximum)
+        parallelism_budget = parallelism.ParallelismBudget(config.parallelism.account_budget)
+        provider_log_level = config.parallelism.provider_log_level
+
+    resource_profiles = resources.ResourceProfiles(
+        default_memory_bytes=config.resources.default_check_memory_mb * 1024 * 1024,
+        history_size=config.resources.history_size, margin=config.resources.margin)
+    if config.resources.memory_budget_mb is not None:
+        logger.info(f"Admitting drift checks within a memory budget of {config.resources.memory_budget_mb} MB")
+        admission_controller = resources.MemoryAdmissionController(config.resources.memory_budget_mb * 1024 * 1024)
+    start_check_runner(config.resources.max_concurrent_checks)
+
+    if config.plan_decoding.process_pool:
+        # Workers are forked from a server process that preloads the terraform tools, not from this process and its
+        # threads. Each worker still imports this module as `__mp_main__` when it starts, which only sets up the module
+        # globals, `main()` is not run
+        logger.info(f"Decoding plans in {config.plan_decoding.workers} worker processes")
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['tools.terraform'])
+        plan_decoder = terraform.PlanDecoder(config.plan_decoding.workers, mp_context=context,
+                                             timeout=config.plan_decoding.timeout)
+
+    if config.tracing.enabled:
+        logger.info(f"Writing drift check spans to {config.tracing.file_path}")
+        tracer = tracing.Tracer(tracing.FileSpanExporter(config.tracing.file_path))
+
     try:
+        if config.cluster.enabled:
+            cluster = setup_cluster(config)
+            cluster.heartbeat()
+            # The heartbeat has a thread of its own, it must never wait behind drift checks or the lease would expire
+            # while this replica is still running the checks of the deployments it owns
+            scheduler.add_executor(SchedulerThreadPoolExecutor(max_workers=1), CLUSTER_HEARTBEAT_EXECUTOR)
+            scheduler.add_job(cluster_heartbeat, 'interval', seconds=config.cluster.heartbeat_interval,
+                              args=[config], id=CLUSTER_HEARTBEAT_JOB_ID, executor=CLUSTER_HEARTBEAT_EXECUTOR,
+                              misfire_grace_time=config.cluster.heartbeat_interval, coalesce=True)
+
         load_jobs(config)
         scheduler.start()
 
-        api = restful_api.API(state)
+        api = restful_api.API(state, cluster=cluster, profiling_token=config.server.profiling_token)
         api.run(host=config.server.host, port=config.server.port)
 
     except (KeyboardInterrupt, SystemExit):
         scheduler.shutdown()
+        if cluster is not None:
+            cluster.leave()
+        if state.dogstatsd is not None:
+            state.dogstatsd.close()
+        if check_executor is not None:
+            check_executor.shutdown(wait=False, cancel_futures=True)
+        if plan_decoder is not None:
+            plan_decoder.shutdown(cancel_futures=True)
         logger.info("Keyboard interrupt received, exiting...")
         return
 
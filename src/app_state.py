@@ -2,7 +2,8 @@ import logging
 import time
 from typing import Dict, Optional, Any
 from tools import terraform
-from prometheus_client import Gauge
+from tools.datadog import DogStatsdClient
+from prometheus_client import Gauge, Histogram
 
 
 class DeploymentState:
@@ -36,6 +37,9 @@ class ApplicationState:
         self.deployment_states: Dict[str, DeploymentState] = {}
         self.restful_api = None
         self.gauges: Dict[str, Gauge] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.prometheus_enabled = True
+        self.dogstatsd: Optional[DogStatsdClient] = None
 
     def set_deployment_state(self, name: str, state: DeploymentState) -> None:
         self.logger.debug(f"Setting deployment state for state named \"{name}\"")
@@ -86,3 +90,26 @@ class ApplicationState:
     def set_gauge(self, name: str, gauge: Gauge) -> None:
         self.logger.debug(f"Setting gauge named \"{name}\"")
         self.gauges[name] = gauge
+
+    def get_histogram(self, name: str) -> Optional[Histogram]:
+        self.logger.debug(f"Getting histogram named \"{name}\"")
+        return self.histograms.get(name, None)
+
+    def set_histogram(self, name: str, histogram: Histogram) -> None:
+        self.logger.debug(f"Setting histogram named \"{name}\"")
+        self.histograms[name] = histogram
+
+    def set_gauge_value(self, name: str, labels: Dict[str, str], value: float,
+                        tags: Optional[Dict[str, str]] = None) -> None:
+        # Fan out to every enabled metrics backend, `tags` are only sent to DogStatsD as Prometheus labels are fixed
+        if self.prometheus_enabled:
+            self.get_gauge(name).labels(**labels).set(value)
+        if self.dogstatsd is not None:
+            self.dogstatsd.gauge(name, value, tags={**(tags or {}), **labels})
+
+    def observe_histogram_value(self, name: str, labels: Dict[str, str], value: float,
+                                tags: Optional[Dict[str, str]] = None) -> None:
+        if self.prometheus_enabled:
+            self.get_histogram(name).labels(**labels).observe(value)
+        if self.dogstatsd is not None:
+            self.dogstatsd.histogram(name, value, tags={**(tags or {}), **labels})
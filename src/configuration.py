@@ -1,5 +1,5 @@
 import yaml
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional
 from apscheduler.job import Job
 
@@ -9,6 +9,7 @@ class ServerConfig:
     host: str
     port: int
     domain: str
+    profiling_token: Optional[str] = None  # Bearer token for `/debug/profile`, the endpoint is disabled when unset
 
 @dataclass
 class GitConfig:
@@ -23,6 +24,67 @@ class NotificationConfig:
     pagerduty: Optional[Dict[str, str]] = None
 
 
+@dataclass
+class DogStatsdConfig:
+    host: str = "localhost"
+    port: int = 8125
+    prefix: str = ""
+    constant_tags: Optional[Dict[str, str]] = None
+    max_packet_size: int = 1432  # In bytes, fits the MTU of most networks
+    flush_interval: float = 1.0  # In seconds
+
+
+@dataclass
+class MetricsConfig:
+    backends: List[str] = field(default_factory=lambda: ["prometheus"])  # Any of: prometheus, dogstatsd
+    dogstatsd: DogStatsdConfig = field(default_factory=DogStatsdConfig)
+
+
+@dataclass
+class ParallelismConfig:
+    adaptive: bool = False
+    initial: int = 10  # Terraform's default
+    minimum: int = 1
+    maximum: int = 64
+    account_budget: int = 64  # Sum of the parallelism of the plans running concurrently on the same cloud account
+    state_file: Optional[str] = None  # Where the learned values are kept across restarts
+    provider_log_level: Optional[str] = None  # Provider logs scanned for throttling, not written when unset
+
+
+@dataclass
+class ResourcesConfig:
+    max_concurrent_checks: int = 10  # Drift checks running at the same time
+    memory_budget_mb: Optional[int] = None  # Admission control is disabled when unset
+    default_check_memory_mb: int = 1024  # Predicted memory of a deployment never checked before
+    history_size: int = 10  # Number of past checks the memory prediction is based on
+    margin: float = 0.2  # Added to the highest recent peak memory
+
+
+@dataclass
+class PlanDecodingConfig:
+    process_pool: bool = False  # Decode and summarize the plans in worker processes, away from the API
+    workers: int = 2
+    timeout: Optional[float] = 600  # In seconds, a check fails instead of waiting longer on a worker
+
+
+@dataclass
+class TracingConfig:
+    enabled: bool = False
+    file_path: str = "spans.jsonl"  # Finished spans are appended to this file, one JSON document per line
+
+
+@dataclass
+class ClusterConfig:
+    enabled: bool = False
+    replica_id: Optional[str] = None  # Defaults to the host name
+    advertise_url: Optional[str] = None  # URL under which peers reach this replica's API, e.g. http://agent-0:8080
+    lease_store: str = "sqlite"  # One of: sqlite, file
+    lease_store_path: str = "/tmp/tfdriftagent-cluster.db"
+    lease_ttl: int = 30  # In seconds
+    heartbeat_interval: int = 10  # In seconds
+    virtual_nodes: int = 64
+
+
 @dataclass
 class Deployment:
     name: str
@@ -33,6 +95,8 @@ class Deployment:
     enabled: bool
     drift_check_interval: int
     notifications: List[str]
+    cloud_account: Optional[str] = None  # Deployments on the same account share the parallelism budget
+    sharding: Optional[Dict[str, int]] = None  # Plan in `shards` concurrent `-target` groups, see config.example.yaml
     active_apscheduler_job: Optional[Job] = None
 
 
@@ -42,6 +106,12 @@ class AppConfig:
     notification_methods: NotificationConfig
     secrets: Dict[str, str]
     server: ServerConfig
+    cluster: ClusterConfig
+    tracing: TracingConfig
+    metrics: MetricsConfig
+    parallelism: ParallelismConfig
+    resources: ResourcesConfig
+    plan_decoding: PlanDecodingConfig
 
 
 def load_config(file_path: str) -> AppConfig:
@@ -58,9 +128,29 @@ def load_config(file_path: str) -> AppConfig:
 
     server = ServerConfig(**config_dict.get('server', {}))
 
+    cluster = ClusterConfig(**config_dict.get('cluster', {}))
+
+    tracing = TracingConfig(**config_dict.get('tracing', {}))
+
+    metrics_dict = dict(config_dict.get('metrics', {}))
+    metrics_dict['dogstatsd'] = DogStatsdConfig(**metrics_dict.get('dogstatsd', {}))
+    metrics = MetricsConfig(**metrics_dict)
+
+    parallelism = ParallelismConfig(**config_dict.get('parallelism', {}))
+
+    resources = ResourcesConfig(**config_dict.get('resources', {}))
+
+    plan_decoding = PlanDecodingConfig(**config_dict.get('plan_decoding', {}))
+
     return AppConfig(
         infrastructure_deployments=infrastructure_deployments,
         notification_methods=notification_methods,
         secrets=secrets,
         server=server,
+        cluster=cluster,
+        tracing=tracing,
+        metrics=metrics,
+        parallelism=parallelism,
+        resources=resources,
+        plan_decoding=plan_decoding,
     )
@@ -1,24 +1,50 @@
-from flask import Flask, jsonify, Response
-from tools import api
+import hmac
+import json
+import logging
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from flask import Flask, jsonify, request, Response
+from tools import api, profiler
+from tools.cluster import ClusterMembership
 import app_state
 from prometheus_client import generate_latest
 
 
 class API:
-    def __init__(self, state: app_state.ApplicationState) -> None:
+    MAX_PROFILE_SECONDS = 300
+
+    def __init__(self, state: app_state.ApplicationState, cluster: Optional[ClusterMembership] = None,
+                 peer_timeout: float = 5.0, profiling_token: Optional[str] = None) -> None:
         self.state = state
+        self.cluster = cluster
+        self.peer_timeout = peer_timeout
+        self.profiling_token = profiling_token
+        self._profiling_lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
 
         self.app = Flask(__name__)
         self.app.route('/api/deployment_states', methods=['GET'])(self.get_deployment_states)
         self.app.route('/api/deployment_states/<string:name>', methods=['GET'])(self.get_deployment_state)
+        self.app.route('/api/cluster/members', methods=['GET'])(self.get_cluster_members)
+        self.app.route('/api/cluster/deployment_states', methods=['GET'])(self.get_cluster_deployment_states)
+        self.app.route('/api/cluster/deployment_states/<string:name>', methods=['GET'])(self.get_cluster_deployment_state)
         self.app.route('/metrics')(self.get_metrics)
+        self.app.route('/debug/profile', methods=['GET'])(self.get_profile)
 
     def get_deployment_states(self):
+        return jsonify(api.FormalItemsList(items=self._get_local_deployment_state_items()).get_item_list())
+
+    def _get_local_deployment_state_items(self) -> list:
         items = self.state.get_deployment_states_as_items()
         # encapsulate every item in the list with the FormalItem class
         for i in range(len(items)):
             items[i] = api.FormalItem(kind="InfrastructureDeploymentState", name=items[i]["name"], spec=items[i]).get_item()
-        return jsonify(api.FormalItemsList(items=items).get_item_list())
+        return items
 
     def get_deployment_state(self, name):
         item = self.state.get_deployment_state_as_item(name=name)
@@ -26,9 +52,82 @@ class API:
             return jsonify({"error": f"State named \"{name}\" not found"}), 404
         return jsonify(api.FormalItem(kind="InfrastructureDeploymentState", name=name, spec=item).get_item())
 
+    def get_cluster_members(self):
+        if self.cluster is None:
+            return jsonify({"error": "Cluster mode is not enabled"}), 404
+        members = self.cluster.get_members()
+        items = [api.FormalItem(kind="AgentReplica", name=replica_id,
+                                spec={"address": address, "self": replica_id == self.cluster.replica_id}).get_item()
+                 for replica_id, address in sorted(members.items())]
+        return jsonify(api.FormalItemsList(items=items).get_item_list())
+
+    def get_cluster_deployment_states(self):
+        # Merge the local states with the ones served by every live peer, peers are queried concurrently
+        items = self._get_local_deployment_state_items()
+        unreachable_peers = []
+
+        if self.cluster is not None:
+            peers = self.cluster.get_peers()
+            with ThreadPoolExecutor(max_workers=max(1, min(len(peers), 8))) as executor:
+                futures = {replica_id: executor.submit(self._fetch_from_peer, address, "/api/deployment_states")
+                           for replica_id, address in peers.items()}
+            for replica_id, future in futures.items():
+                try:
+                    items.extend(future.result()["items"])
+                except Exception as e:
+                    self.logger.warning(f"Unable to fetch deployment states from replica \"{replica_id}\": {e}")
+                    unreachable_peers.append(replica_id)
+
+        return jsonify(api.FormalItemsList(items=items, metadata={"unreachablePeers": unreachable_peers}).get_item_list())
+
+    def get_cluster_deployment_state(self, name):
+        if self.cluster is None or self.cluster.owns(name):
+            return self.get_deployment_state(name)
+
+        # Proxy the request to the replica owning the deployment
+        owner = self.cluster.get_owner(name)
+        address = self.cluster.get_member_address(owner)
+        try:
+            return jsonify(self._fetch_from_peer(address, f"/api/deployment_states/{urllib.parse.quote(name)}"))
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return jsonify({"error": f"State named \"{name}\" not found"}), 404
+            return jsonify({"error": f"Replica \"{owner}\" answered with HTTP {e.code}"}), 502
+        except Exception as e:
+            return jsonify({"error": f"Replica \"{owner}\" is unreachable: {e}"}), 502
+
+    def _fetch_from_peer(self, address: str, path: str) -> dict:
+        with urllib.request.urlopen(address.rstrip('/') + path, timeout=self.peer_timeout) as response:
+            return json.loads(response.read())
+
     def get_metrics(self):
         return Response(generate_latest(), mimetype="text/plain")
 
+    def get_profile(self):
+        # The endpoint is disabled unless a token is configured
+        if not self.profiling_token:
+            return jsonify({"error": "Profiling is not enabled"}), 404
+
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {self.profiling_token}".encode()):
+            return jsonify({"error": "Unauthorized"}), 401
+
+        try:
+            seconds = float(request.args.get('seconds', 10))
+        except ValueError:
+            return jsonify({"error": "Parameter \"seconds\" must be a number"}), 400
+        if not 0 < seconds <= self.MAX_PROFILE_SECONDS:
+            return jsonify({"error": f"Parameter \"seconds\" must be between 0 and {self.MAX_PROFILE_SECONDS}"}), 400
+
+        # Only one profile at a time, concurrent samplers would skew each other
+        if not self._profiling_lock.acquire(blocking=False):
+            return jsonify({"error": "A profile is already being captured"}), 409
+        try:
+            self.logger.info(f"Capturing a {seconds}s CPU profile")
+            return Response(profiler.sample_cpu_profile(seconds), mimetype="text/plain")
+        finally:
+            self._profiling_lock.release()
+
     def run(self, host='0.0.0.0', port=8888):
         self.app.run(host=host, port=port)
 
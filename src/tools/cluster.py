@@ -0,0 +1,215 @@
+import abc
+import bisect
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+
+@dataclass
+class Lease:
+    replica_id: str
+    address: str
+    expires_at: float
+
+
+class LeaseStore(abc.ABC):
+    """
+    Shared store in which every agent replica periodically renews a lease. A replica whose lease has expired is
+    considered dead, and the deployments it owned are rebalanced to the remaining replicas.
+    """
+
+    @abc.abstractmethod
+    def renew(self, replica_id: str, address: str, ttl: float) -> None:
+        pass
+
+    @abc.abstractmethod
+    def release(self, replica_id: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def live_leases(self) -> List[Lease]:
+        pass
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """Lease store backed by a SQLite database file, shared by replicas running on the same host or volume."""
+
+    def __init__(self, path: str, timeout: float = 5.0) -> None:
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS leases ("
+                               "replica_id TEXT PRIMARY KEY, address TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def renew(self, replica_id: str, address: str, ttl: float) -> None:
+        with self._connect() as connection:
+            connection.execute("INSERT INTO leases (replica_id, address, expires_at) VALUES (?, ?, ?) "
+                               "ON CONFLICT(replica_id) DO UPDATE SET address = excluded.address, "
+                               "expires_at = excluded.expires_at",
+                               (replica_id, address, time.time() + ttl))
+
+    def release(self, replica_id: str) -> None:
+        with self._connect() as connection:
+            connection.execute("DELETE FROM leases WHERE replica_id = ?", (replica_id,))
+
+    def live_leases(self) -> List[Lease]:
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("DELETE FROM leases WHERE expires_at <= ?", (now,))
+            rows = connection.execute("SELECT replica_id, address, expires_at FROM leases").fetchall()
+        return [Lease(replica_id=row[0], address=row[1], expires_at=row[2]) for row in rows]
+
+
+class FileLeaseStore(LeaseStore):
+    """
+    Lease store backed by a shared directory, one JSON file per replica. Files are replaced atomically so readers
+    never see a partially written lease.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _lease_file(self, replica_id: str) -> str:
+        return os.path.join(self.path, hashlib.sha1(replica_id.encode("utf-8")).hexdigest() + ".lease")
+
+    def renew(self, replica_id: str, address: str, ttl: float) -> None:
+        lease = {"replica_id": replica_id, "address": address, "expires_at": time.time() + ttl}
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(lease, file)
+            os.replace(tmp_path, self._lease_file(replica_id))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def release(self, replica_id: str) -> None:
+        try:
+            os.remove(self._lease_file(replica_id))
+        except FileNotFoundError:
+            pass
+
+    def live_leases(self) -> List[Lease]:
+        logger = logging.getLogger(__name__)
+        now = time.time()
+        leases = []
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith(".lease"):
+                continue
+            try:
+                with open(os.path.join(self.path, file_name), "r") as file:
+                    lease = Lease(**json.load(file))
+            except (OSError, ValueError, TypeError) as e:
+                logger.debug(f"Ignoring unreadable lease file \"{file_name}\": {e}")
+                continue
+            if lease.expires_at > now:
+                leases.append(lease)
+        return leases
+
+
+def create_lease_store(backend: str, path: str) -> LeaseStore:
+    if backend == "sqlite":
+        return SQLiteLeaseStore(path)
+    if backend == "file":
+        return FileLeaseStore(path)
+    raise ValueError(f"Unsupported lease store backend: {backend}")
+
+
+class ConsistentHashRing:
+    """
+    Consistent hash ring mapping keys (deployment names) to members (replica ids). Each member is placed on the ring
+    several times (virtual nodes) so that keys are spread evenly and only ~1/N of them move when a member joins or
+    leaves.
+    """
+
+    def __init__(self, members: Iterable[str], virtual_nodes: int = 64) -> None:
+        self.virtual_nodes = virtual_nodes
+        self.members = sorted(set(members))
+        self._ring: List[int] = []
+        self._owners: Dict[int, str] = {}
+        for member in self.members:
+            for i in range(virtual_nodes):
+                point = self._hash(f"{member}#{i}")
+                self._owners[point] = member
+                bisect.insort(self._ring, point)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def get_owner(self, key: str) -> Optional[str]:
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._ring, self._hash(key)) % len(self._ring)
+        return self._owners[self._ring[index]]
+
+
+class ClusterMembership:
+    """
+    Tracks the live replicas of the agent through a lease store and decides which deployments this replica owns.
+    """
+
+    def __init__(self, store: LeaseStore, replica_id: str, address: str, lease_ttl: float = 30,
+                 virtual_nodes: int = 64) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.store = store
+        self.replica_id = replica_id
+        self.address = address
+        self.lease_ttl = lease_ttl
+        self.virtual_nodes = virtual_nodes
+        self._lock = threading.Lock()
+        self._members: Dict[str, str] = {replica_id: address}
+        self._ring = ConsistentHashRing(self._members, virtual_nodes=virtual_nodes)
+
+    def heartbeat(self) -> bool:
+        """
+        Renews this replica's lease and refreshes the list of live replicas.
+        Returns True when the membership changed since the previous heartbeat.
+        """
+        self.store.renew(self.replica_id, self.address, self.lease_ttl)
+        members = {lease.replica_id: lease.address for lease in self.store.live_leases()}
+        # Our own lease was just renewed, but make sure we never drop ourselves because of clock skew
+        members[self.replica_id] = self.address
+
+        with self._lock:
+            if members == self._members:
+                return False
+            self.logger.info(f"Cluster membership changed: {sorted(members)}")
+            self._members = members
+            self._ring = ConsistentHashRing(members, virtual_nodes=self.virtual_nodes)
+            return True
+
+    def leave(self) -> None:
+        self.logger.info(f"Releasing cluster lease for replica \"{self.replica_id}\"")
+        self.store.release(self.replica_id)
+
+    def get_owner(self, name: str) -> Optional[str]:
+        with self._lock:
+            return self._ring.get_owner(name)
+
+    def owns(self, name: str) -> bool:
+        return self.get_owner(name) == self.replica_id
+
+    def get_member_address(self, replica_id: str) -> Optional[str]:
+        with self._lock:
+            return self._members.get(replica_id)
+
+    def get_members(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._members)
+
+    def get_peers(self) -> Dict[str, str]:
+        return {replica_id: address for replica_id, address in self.get_members().items()
+                if replica_id != self.replica_id}
@@ -1,4 +1,11 @@
+import functools
+import logging
+import queue
 import re
+import socket
+import threading
+import time
+from typing import Dict, Optional, Tuple
 
 
 def is_valid_datadog_tag(tag: str) -> bool:
@@ -9,6 +16,7 @@ def is_valid_datadog_tag(tag: str) -> bool:
     return bool(pattern.match(tag))
 
 
+@functools.lru_cache(maxsize=4096)
 def convert_to_datadog_tag(s: str) -> (str, bool):
     """Converts a string into a valid Datadog tag by replacing invalid characters with underscores."""
     original_s = s
@@ -17,3 +25,89 @@ def convert_to_datadog_tag(s: str) -> (str, bool):
     s = re.sub(r'^[^a-zA-Z]', '', s)  # Removes non-alphabetic characters at the beginning
     s = s[:200]  # Truncate to 200 characters
     return s, (original_s != s)
+
+
+@functools.lru_cache(maxsize=1024)
+def convert_to_datadog_tags(tags: Tuple[Tuple[str, str], ...]) -> Tuple[str, ...]:
+    """Converts `(key, value)` pairs into valid `key:value` Datadog tags, memoized as the same tags are sent often."""
+    return tuple(convert_to_datadog_tag(f"{key}:{value}")[0] for key, value in tags)
+
+
+class DogStatsdClient:
+    """
+    Pushes metrics to a DogStatsD agent over UDP.
+    https://docs.datadoghq.com/developers/dogstatsd/datagram_shell/
+
+    Metrics are queued and a background thread packs them in datagrams of up to `max_packet_size` bytes, sent when
+    full or every `flush_interval` seconds. Emitting a metric never blocks, metrics are dropped when the queue is full.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 8125, prefix: str = "",
+                 constant_tags: Optional[Dict[str, str]] = None, max_packet_size: int = 1432,
+                 flush_interval: float = 1.0, max_queue_size: int = 10000) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.address = (host, port)
+        self.prefix = f"{prefix}." if prefix else ""
+        self.constant_tags = convert_to_datadog_tags(tuple(sorted((constant_tags or {}).items())))
+        self.max_packet_size = max_packet_size
+        self.flush_interval = flush_interval
+        self.dropped_metrics = 0
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="dogstatsd-flusher", daemon=True)
+        self._thread.start()
+
+    def gauge(self, name: str, value: float, tags: Optional[Dict[str, str]] = None) -> None:
+        self._enqueue(name, value, "g", tags)
+
+    def histogram(self, name: str, value: float, tags: Optional[Dict[str, str]] = None) -> None:
+        self._enqueue(name, value, "h", tags)
+
+    def _enqueue(self, name: str, value: float, metric_type: str, tags: Optional[Dict[str, str]]) -> None:
+        all_tags = self.constant_tags + convert_to_datadog_tags(tuple(sorted((tags or {}).items())))
+        line = f"{self.prefix}{name}:{value}|{metric_type}"
+        if all_tags:
+            line += "|#" + ",".join(all_tags)
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped_metrics += 1
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._flush(deadline=time.monotonic() + self.flush_interval)
+        self._flush(deadline=time.monotonic())
+
+    def _flush(self, deadline: float) -> None:
+        # Pack as many queued lines as possible in each datagram until the deadline, then send what is left
+        packet = ""
+        while True:
+            timeout = deadline - time.monotonic()
+            try:
+                line = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if packet and len(packet) + 1 + len(line) > self.max_packet_size:
+                self._send(packet)
+                packet = ""
+            packet = f"{packet}\n{line}" if packet else line
+        if packet:
+            self._send(packet)
+
+        if self.dropped_metrics:
+            dropped_metrics, self.dropped_metrics = self.dropped_metrics, 0
+            self.logger.warning(f"Dropped {dropped_metrics} metrics because the DogStatsD queue was full")
+
+    def _send(self, packet: str) -> None:
+        try:
+            self._socket.sendto(packet.encode("utf-8"), self.address)
+        except OSError as e:
+            self.logger.debug(f"Unable to send metrics to DogStatsD at {self.address}: {e}")
+
+    def close(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        self._socket.close()
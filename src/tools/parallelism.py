@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+
+class AdaptiveParallelismController:
+    """
+    Tunes the `terraform plan -parallelism` of every deployment between runs with an AIMD (additive increase,
+    multiplicative decrease) rule:
+    - when the plan hit API throttling, the parallelism is multiplied by `decrease_factor`;
+    - when the plan got noticeably slower than the previous one of the same mode (full or sharded plan), the
+      parallelism is multiplied by `decrease_factor` too, as the slowdown usually comes from API calls retried after
+      a throttling that was not reported;
+    - otherwise the parallelism is increased by `increase_step`.
+
+    The learned values are saved to `state_file` so they survive restarts.
+    """
+
+    def __init__(self, state_file: Optional[str] = None, initial: int = 10, minimum: int = 1, maximum: int = 64,
+                 increase_step: int = 2, decrease_factor: float = 0.5, slowdown_tolerance: float = 1.2) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.state_file = state_file
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.slowdown_tolerance = slowdown_tolerance
+        self._lock = threading.Lock()
+        self._deployments: Dict[str, Dict[str, Any]] = self._load()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Unable to load learned parallelism from {self.state_file}, starting over: {e}")
+            return {}
+
+    def _save(self) -> None:
+        if self.state_file is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(self._deployments, file)
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            self.logger.warning(f"Unable to save learned parallelism to {self.state_file}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return int(self._deployments.get(name, {}).get("parallelism", self.initial))
+
+    def update(self, name: str, plan_duration: Optional[float], throttling_events: int, plan_mode: str = "full") -> int:
+        """
+        Feeds the outcome of a plan run with `get(name)` to the controller and returns the next parallelism.
+        `plan_duration` is None when the plan failed, its duration is then not compared with the next plans.
+        A full plan and a sharded plan take very different times, the duration is only compared with the previous
+        plan of the same `plan_mode`.
+        """
+        with self._lock:
+            deployment = self._deployments.setdefault(name, {"parallelism": self.initial})
+            current = deployment["parallelism"]
+            plan_durations = deployment.setdefault("plan_durations", {})
+            previous_duration = plan_durations.get(plan_mode)
+
+            if throttling_events > 0:
+                new = current * self.decrease_factor
+                reason = f"{throttling_events} throttling events"
+            elif plan_duration is None:
+                new = current
+                reason = "plan failed"
+            elif previous_duration is not None and plan_duration > previous_duration * self.slowdown_tolerance:
+                new = current * self.decrease_factor
+                reason = f"plan slowed down from {previous_duration:.1f}s to {plan_duration:.1f}s"
+            else:
+                new = current + self.increase_step
+                reason = "no throttling"
+
+            new = max(self.minimum, min(self.maximum, int(new)))
+            deployment["parallelism"] = new
+            if plan_duration is not None:
+                plan_durations[plan_mode] = plan_duration
+            self._save()
+
+        if new != current:
+            self.logger.info(f"Parallelism for deployment \"{name}\" changed from {current} to {new} ({reason})")
+        return new
+
+
+class ParallelismBudget:
+    """
+    Caps the sum of the parallelism of the plans running concurrently against the same cloud account, so that they
+    share the account's API rate limits instead of throttling each other.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._condition = threading.Condition()
+        self._used: Dict[str, int] = {}
+
+    @contextmanager
+    def reserve(self, account: str, requested: int) -> Iterator[int]:
+        """Waits until `requested` (capped to the capacity) is available for the account and yields it."""
+        granted = max(1, min(requested, self.capacity))
+        with self._condition:
+            self._condition.wait_for(lambda: self._used.get(account, 0) + granted <= self.capacity)
+            self._used[account] = self._used.get(account, 0) + granted
+        try:
+            yield granted
+        finally:
+            with self._condition:
+                self._used[account] -= granted
+                self._condition.notify_all()
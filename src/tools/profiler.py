@@ -0,0 +1,56 @@
+import collections
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+# Python functions in which threads park while waiting, used to tell idle threads apart when the per-thread CPU
+# clocks are not available
+IDLE_FUNCTIONS = {'wait', 'wait_for', 'select', 'poll', 'sleep', 'acquire', 'accept', 'get', '_wait_for_tstate_lock'}
+
+
+def _thread_cpu_time(thread_id: int) -> Optional[float]:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError):
+        return None
+
+
+def sample_cpu_profile(seconds: float, interval: float = 0.01) -> str:
+    """
+    Samples the Python stack of the threads of the process that are using CPU, at the given interval for the given
+    number of seconds. Returns the samples aggregated in the "collapsed stacks" format (one `frame;frame;frame count`
+    per line), which can be fed as-is to flamegraph.pl or speedscope.
+
+    A thread is sampled only when its CPU clock advanced since the previous sample (where per-thread CPU clocks are
+    available) and it is not parked in a known waiting function.
+    """
+    own_thread_id = threading.get_ident()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    cpu_times: Dict[int, Optional[float]] = {}
+    counts: Dict[str, int] = collections.Counter()
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+
+            cpu_time = _thread_cpu_time(thread_id)
+            previous_cpu_time = cpu_times.get(thread_id)
+            cpu_times[thread_id] = cpu_time
+            if cpu_time is not None and (previous_cpu_time is None or cpu_time <= previous_cpu_time):
+                continue
+            if frame.f_code.co_name in IDLE_FUNCTIONS:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
@@ -0,0 +1,226 @@
+import collections
+import logging
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError
+from typing import Deque, Dict, List, Optional, Tuple
+
+# `ru_maxrss` is in kilobytes on Linux and in bytes on macOS
+MAX_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+# `ru_inblock` and `ru_oublock` count 512 bytes blocks
+IO_BLOCK_SIZE = 512
+# How often a running process is checked for cancellation and its memory sampled, in seconds
+MONITOR_INTERVAL = 0.5
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class ProcessUsage:
+    """Resources used by a subprocess, as reported by the kernel when it was reaped."""
+
+    def __init__(self, command: str, wall_time: float = 0.0, cpu_user_time: float = 0.0, cpu_system_time: float = 0.0,
+                 max_rss_bytes: int = 0, read_bytes: int = 0, write_bytes: int = 0) -> None:
+        self.command = command
+        self.wall_time = wall_time
+        self.cpu_user_time = cpu_user_time
+        self.cpu_system_time = cpu_system_time
+        self.max_rss_bytes = max_rss_bytes
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    @property
+    def cpu_time(self) -> float:
+        return self.cpu_user_time + self.cpu_system_time
+
+    @classmethod
+    def from_rusage(cls, command: str, wall_time: float, rusage: resource.struct_rusage) -> 'ProcessUsage':
+        return cls(command, wall_time=wall_time, cpu_user_time=rusage.ru_utime, cpu_system_time=rusage.ru_stime,
+                   max_rss_bytes=rusage.ru_maxrss * MAX_RSS_UNIT, read_bytes=rusage.ru_inblock * IO_BLOCK_SIZE,
+                   write_bytes=rusage.ru_oublock * IO_BLOCK_SIZE)
+
+    def __repr__(self) -> str:
+        return f"ProcessUsage(command={self.command}, wall_time={self.wall_time:.1f}, cpu_time={self.cpu_time:.1f}, " \
+               f"max_rss_bytes={self.max_rss_bytes}, read_bytes={self.read_bytes}, write_bytes={self.write_bytes})"
+
+
+def get_process_group_rss(process_group_id: int) -> Optional[int]:
+    """
+    Sums the current RSS of the processes of a process group, read from `/proc`. Returns None where `/proc` is not
+    available.
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    total_rss = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as file:
+                stat = file.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, the fields are counted from its closing parenthesis
+        fields = stat[stat.rindex(b')') + 2:].split()
+        if int(fields[2]) == process_group_id:
+            total_rss += int(fields[21]) * PAGE_SIZE
+    return total_rss
+
+
+def run_with_usage(args: List[str], cwd: Optional[str] = None, timeout: Optional[float] = None,
+                   stdout_path: Optional[str] = None, env: Optional[Dict[str, str]] = None,
+                   cancel: Optional[threading.Event] = None) -> Tuple[subprocess.CompletedProcess, ProcessUsage]:
+    """
+    Same as `subprocess.run(args, cwd=cwd, capture_output=True, text=True, timeout=timeout)`, but reaps the process
+    with `wait4` to also return the resources it used.
+    `ru_maxrss` is only the peak of the biggest process reaped, not of the process and its children (e.g. terraform
+    and its provider plugins) together. Their RSS is also summed periodically, the highest of both is kept.
+    When `stdout_path` is given, the standard output is written to that file instead of being captured.
+    The `env` variables are added to the environment of the process.
+    When the `cancel` event is set, the process is killed, or not started, and `CancelledError` is raised.
+    """
+    if cancel is not None and cancel.is_set():
+        raise CancelledError()
+
+    start_time = time.time()
+    stdout_file = open(stdout_path, 'w') if stdout_path is not None else None
+    try:
+        process = subprocess.Popen(args, cwd=cwd, stdout=stdout_file if stdout_file is not None else subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True,
+                                   env={**os.environ, **env} if env is not None else None, start_new_session=True)
+    finally:
+        # The child has its own copy of the file descriptor
+        if stdout_file is not None:
+            stdout_file.close()
+
+    # Drain the pipes concurrently so that the process never blocks on a full pipe
+    outputs: Dict[str, str] = {}
+    readers = [threading.Thread(target=lambda name, stream: outputs.__setitem__(name, stream.read()),
+                                args=(name, stream), daemon=True)
+               for name, stream in (('stdout', process.stdout), ('stderr', process.stderr)) if stream is not None]
+    for reader in readers:
+        reader.start()
+
+    def kill_process_group() -> None:
+        # The children of the process (e.g. terraform provider plugins) are killed too, they would otherwise keep the
+        # pipes open
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timed_out = threading.Event()
+
+    def kill() -> None:
+        timed_out.set()
+        kill_process_group()
+
+    timer = threading.Timer(timeout, kill) if timeout is not None else None
+    if timer is not None:
+        timer.start()
+
+    reaped = threading.Event()
+    cancelled = threading.Event()
+    peak_group_rss = 0
+
+    def monitor() -> None:
+        nonlocal peak_group_rss
+        while not reaped.wait(MONITOR_INTERVAL):
+            if cancel is not None and cancel.is_set():
+                cancelled.set()
+                kill_process_group()
+                return
+            group_rss = get_process_group_rss(process.pid)
+            if group_rss is not None:
+                peak_group_rss = max(peak_group_rss, group_rss)
+
+    threading.Thread(target=monitor, daemon=True).start()
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    finally:
+        reaped.set()
+        if timer is not None:
+            timer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    for reader in readers:
+        reader.join()
+    for stream in (process.stdout, process.stderr):
+        if stream is not None:
+            stream.close()
+
+    if cancelled.is_set():
+        raise CancelledError()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(args, timeout, output=outputs.get('stdout'), stderr=outputs.get('stderr'))
+
+    usage = ProcessUsage.from_rusage(' '.join(args[:2]), time.time() - start_time, rusage)
+    usage.max_rss_bytes = max(usage.max_rss_bytes, peak_group_rss)
+    return subprocess.CompletedProcess(args, process.returncode, outputs.get('stdout'), outputs.get('stderr')), usage
+
+
+class ResourceProfiles:
+    """
+    Keeps the peak memory of the last `history_size` checks of every deployment to predict the memory of the next
+    check: the highest recent peak plus a safety `margin`, or `default_memory_bytes` for a deployment never checked.
+    """
+
+    def __init__(self, default_memory_bytes: int, history_size: int = 10, margin: float = 0.2) -> None:
+        self.default_memory_bytes = default_memory_bytes
+        self.history_size = history_size
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._peaks: Dict[str, Deque[int]] = {}
+
+    def record(self, name: str, peak_rss_bytes: int) -> None:
+        with self._lock:
+            self._peaks.setdefault(name, collections.deque(maxlen=self.history_size)).append(peak_rss_bytes)
+
+    def predict_memory(self, name: str) -> int:
+        with self._lock:
+            peaks = self._peaks.get(name)
+            if not peaks:
+                return self.default_memory_bytes
+            return int(max(peaks) * (1 + self.margin))
+
+
+class MemoryAdmissionController:
+    """
+    Admits the checks in the order they arrived, each one only when its predicted memory fits in what is left of the
+    budget. A check predicted to need more than the whole budget is still admitted once nothing else runs, and the
+    checks arrived after it wait behind it, so that it is never starved.
+    """
+
+    def __init__(self, budget_bytes: int) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.budget_bytes = budget_bytes
+        self.reserved_bytes = 0
+        self._running = 0
+        self._waiting: Deque[object] = collections.deque()
+        self._condition = threading.Condition()
+
+    def acquire(self, predicted_bytes: int, timeout: Optional[float] = None) -> bool:
+        ticket = object()
+        with self._condition:
+            self._waiting.append(ticket)
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self._waiting[0] is ticket and
+                    (self._running == 0 or self.reserved_bytes + predicted_bytes <= self.budget_bytes), timeout)
+                if admitted:
+                    self.reserved_bytes += predicted_bytes
+                    self._running += 1
+                return admitted
+            finally:
+                # Admitted or timed out, the next waiter is now first in line
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+    def release(self, predicted_bytes: int) -> None:
+        with self._condition:
+            self.reserved_bytes -= predicted_bytes
+            self._running -= 1
+            self._condition.notify_all()
@@ -1,8 +1,144 @@
 import os
+import hashlib
 import json
 import logging
+import re
+import shutil
 import subprocess
-from typing import Tuple, Dict, Any, Optional
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.context import BaseContext
+from typing import Tuple, Dict, Any, List, Optional
+from tools.resources import ProcessUsage, run_with_usage
+
+
+# Error codes and HTTP status returned by the cloud provider APIs when a call was rate limited and had to be retried.
+# Case-sensitive and whole words only, as API responses hold fields such as `throttlingBurstLimit` or
+# `throttling_rate_limit` (API Gateway stages and usage plans)
+THROTTLING_PATTERN = re.compile(r'\b(?:ThrottlingException|Throttling: Rate exceeded|RequestLimitExceeded|'
+                                r'TooManyRequestsException|RequestThrottled|rateLimitExceeded|'
+                                r'429 Too Many Requests|StatusCode: 429)\b')
+
+
+def count_throttling_events(output: str) -> int:
+    """Counts the lines of a terraform command output that report API throttling."""
+    return sum(1 for line in output.splitlines() if THROTTLING_PATTERN.search(line))
+
+
+# Terraform only prints the throttled and retried API calls in the provider logs, they are written to this file of the
+# planned directory rather than to the output of the command
+PROVIDER_LOG_FILE = 'terraform-provider.log'
+
+
+def get_provider_log_env(directory: str, log_level: Optional[str]) -> Dict[str, str]:
+    """Returns the environment variables writing the provider logs at `log_level` to the provider log file."""
+    if log_level is None:
+        return {}
+    return {'TF_LOG_PROVIDER': log_level, 'TF_LOG_PATH': os.path.join(directory, PROVIDER_LOG_FILE)}
+
+
+def count_logged_throttling_events(directory: str) -> int:
+    """
+    Counts the lines of the provider log file of a directory that report API throttling, then removes the file.
+    The file is read line by line, as provider logs can be big.
+    """
+    log_path = os.path.join(directory, PROVIDER_LOG_FILE)
+    try:
+        with open(log_path, 'r', errors='replace') as file:
+            return sum(1 for line in file if THROTTLING_PATTERN.search(line))
+    except FileNotFoundError:
+        return 0
+    finally:
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+
+TOP_LEVEL_MODULE_PATTERN = re.compile(r'^(module\.[^.\[]+)')
+ROOT_RESOURCE_PATTERN = re.compile(r'^([^.\[]+\.[^.\[]+)')
+
+
+def get_top_level_target(address: str) -> Optional[str]:
+    """
+    Returns the `-target` covering a resource address: its top-level module, or the resource itself without instance
+    key when it is declared in the root module. Data sources are not targeted, they are read as dependencies.
+    """
+    match = TOP_LEVEL_MODULE_PATTERN.match(address)
+    if match:
+        return match.group(1)
+    if address.startswith('data.'):
+        return None
+    match = ROOT_RESOURCE_PATTERN.match(address)
+    return match.group(1) if match else None
+
+
+def group_addresses_by_target(addresses: List[str]) -> Dict[str, int]:
+    """Counts the resources covered by each top-level target."""
+    targets: Dict[str, int] = {}
+    for address in addresses:
+        target = get_top_level_target(address)
+        if target is not None:
+            targets[target] = targets.get(target, 0) + 1
+    return targets
+
+
+# Top-level `resource` and `module` blocks of a `.tf` file, labels may be quoted or not
+CONFIGURATION_BLOCK_PATTERN = re.compile(r'^(resource|module)\s+"?([\w-]+)"?(?:\s+"?([\w-]+)"?)?\s*\{', re.MULTILINE)
+
+
+def list_configuration_targets(directory: str) -> Dict[str, int]:
+    """
+    Lists the top-level targets declared in the `.tf` and `.tf.json` files of a directory, including the modules and
+    resources added to the code since the last plan. Their size is unknown, each one counts as a single resource.
+    """
+    targets: Dict[str, int] = {}
+    for file_name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file_name)
+        if file_name.endswith('.tf'):
+            with open(path, 'r') as file:
+                for kind, first_label, second_label in CONFIGURATION_BLOCK_PATTERN.findall(file.read()):
+                    if kind == 'module':
+                        targets[f'module.{first_label}'] = 1
+                    elif second_label:
+                        targets[f'{first_label}.{second_label}'] = 1
+        elif file_name.endswith('.tf.json'):
+            with open(path, 'r') as file:
+                configuration = json.load(file)
+            for module_name in configuration.get('module', {}):
+                targets[f'module.{module_name}'] = 1
+            for resource_type, resources in configuration.get('resource', {}).items():
+                for resource_name in resources:
+                    targets[f'{resource_type}.{resource_name}'] = 1
+    return targets
+
+
+def split_into_shards(targets: Dict[str, int], shards: int) -> List[List[str]]:
+    """Spreads the targets over the shards, biggest first into the lightest shard, so shards hold similar counts."""
+    buckets: List[List[str]] = [[] for _ in range(min(shards, len(targets)))]
+    loads = [0] * len(buckets)
+    for target, count in sorted(targets.items(), key=lambda item: (-item[1], item[0])):
+        lightest = loads.index(min(loads))
+        buckets[lightest].append(target)
+        loads[lightest] += count
+    return buckets
+
+
+def merge_plans(plans: List[dict]) -> dict:
+    """
+    Merges the plans of several shards into a single plan. A resource can appear in several shards because `-target`
+    also plans the dependencies of the targets, in which case the entry with an actual change is kept.
+    """
+    merged = dict(plans[0])
+    resource_changes: Dict[str, dict] = {}
+    for plan in plans:
+        for resource_change in plan.get('resource_changes', []):
+            address = resource_change['address']
+            if address not in resource_changes or resource_changes[address]['change']['actions'] == ['no-op']:
+                resource_changes[address] = resource_change
+    merged['resource_changes'] = list(resource_changes.values())
+    return merged
 
 
 class ConsoleException(Exception):
@@ -68,6 +204,32 @@ class TerraformPlan:
     def has_changes(self) -> bool:
         return any(self.count_resources().values())
 
+    def get_top_level_targets(self) -> Dict[str, int]:
+        return group_addresses_by_target([resource['address'] for resource in self.plan.get('resource_changes', [])])
+
+    def get_summary(self) -> dict:
+        """
+        Returns what the agent keeps of the plan: the counts, the addresses of the drifted resources and a fingerprint
+        of each of their changes, to tell whether a drift is the same as in a previous plan.
+        """
+        excluded_actions = {'no-op', 'read'}
+        fingerprints = {}
+        for resource in self.plan.get('resource_changes', []):
+            if any(action not in excluded_actions for action in resource['change']['actions']):
+                change = json.dumps(resource['change'], sort_keys=True, default=str)
+                fingerprints[resource['address']] = hashlib.sha256(change.encode('utf-8')).hexdigest()
+        return {
+            "format_version": self.format_version,
+            "terraform_version": self.terraform_version,
+            "timestamp": self.timestamp,
+            "action_counts": self.count_resources(),
+            "changes_count": self.count_resources_except_noop_and_read(),
+            "total_resources": self.count_total_resources(),
+            "top_level_targets": self.get_top_level_targets(),
+            "drifted_addresses": list(fingerprints),
+            "fingerprints": fingerprints,
+        }
+
     def get_changes_breakdown(self) -> str:
         changes = self.count_resources()
         breakdown = []
@@ -77,64 +239,394 @@ class TerraformPlan:
         return ', '.join(breakdown)
 
 
+class TerraformPlanSummary(TerraformPlan):
+    """
+    A Terraform plan reduced to what `TerraformPlan.get_summary` keeps, with the same interface as `TerraformPlan`.
+    """
+    def __init__(self, summary: dict):
+        super().__init__({key: summary[key] for key in ('format_version', 'terraform_version', 'timestamp')})
+        self.summary = summary
+
+    @property
+    def drifted_addresses(self) -> List[str]:
+        return self.summary['drifted_addresses']
+
+    @property
+    def fingerprints(self) -> Dict[str, str]:
+        return self.summary['fingerprints']
+
+    def count_resources_by_action(self, action: str) -> int:
+        return self.summary['action_counts'].get(action, 0)
+
+    def count_resources_except_noop_and_read(self) -> int:
+        return self.summary['changes_count']
+
+    def count_total_resources(self) -> int:
+        return self.summary['total_resources']
+
+    def get_top_level_targets(self) -> Dict[str, int]:
+        return self.summary['top_level_targets']
+
+    def get_summary(self) -> dict:
+        return self.summary
+
+
+def summarize_plan_files(paths: List[str]) -> dict:
+    """
+    Loads the JSON plans written by `terraform show -json`, merges them and returns their summary.
+    Meant to run in a worker process, so that the process running the API never decodes the whole plan.
+    """
+    plans = []
+    for path in paths:
+        with open(path, 'r') as file:
+            plans.append(json.load(file))
+    return TerraformPlan(merge_plans(plans)).get_summary()
+
+
+class PlanDecoder:
+    """
+    Pool of worker processes running `summarize_plan_files`. A worker that dies (e.g. killed by the OOM killer) breaks
+    a `ProcessPoolExecutor` for good, so the pool is then rebuilt and the plan is summarized again in the new pool.
+    A plan not summarized within `timeout` seconds fails with a `ConsoleException`, and the workers of the pool are
+    killed in case one of them hung.
+    """
+
+    def __init__(self, workers: int, mp_context: Optional[BaseContext] = None, timeout: Optional[float] = None) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.workers = workers
+        self.mp_context = mp_context
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pool = self._create_pool()
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context)
+
+    def _rebuild_pool(self, broken_pool: ProcessPoolExecutor, kill_workers: bool = False) -> ProcessPoolExecutor:
+        with self._lock:
+            # Concurrent plans see the same broken pool, it is only rebuilt once
+            if self._pool is broken_pool:
+                if kill_workers:
+                    # `ProcessPoolExecutor` has no public way to terminate its workers before Python 3.14
+                    for process in list((getattr(broken_pool, '_processes', None) or {}).values()):
+                        process.kill()
+                broken_pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._create_pool()
+            return self._pool
+
+    def _summarize_in(self, pool: ProcessPoolExecutor, paths: List[str]) -> 'TerraformPlanSummary':
+        future = pool.submit(summarize_plan_files, paths)
+        try:
+            return TerraformPlanSummary(future.result(timeout=self.timeout))
+        except FutureTimeoutError:
+            self._rebuild_pool(pool, kill_workers=True)
+            raise ConsoleException(f"Summarizing the plan took longer than {self.timeout} seconds", ', '.join(paths))
+
+    def summarize(self, paths: List[str]) -> 'TerraformPlanSummary':
+        with self._lock:
+            pool = self._pool
+        try:
+            return self._summarize_in(pool, paths)
+        except BrokenProcessPool as e:
+            self.logger.warning(f"A plan decoding worker died, summarizing the plan again in a new pool: {e}")
+            # A second failure most likely comes from the plan itself, it is not summarized in this process
+            return self._summarize_in(self._rebuild_pool(pool), paths)
+
+    def shutdown(self, cancel_futures: bool = False) -> None:
+        with self._lock:
+            self._pool.shutdown(cancel_futures=cancel_futures)
+
+
+class PlanRunStats:
+    """
+    Collects measurements about a run of `init_and_plan`, filled in as the run progresses so that the measurements
+    of the completed phases are available even when a later phase fails.
+    """
+    def __init__(self) -> None:
+        self.phase_times: Dict[str, Tuple[float, float]] = {}
+        self.throttling_events = 0
+        self.plan_succeeded = False
+        self.plan_mode = 'full'
+        self.process_usages: List[ProcessUsage] = []
+        self.peak_rss_bytes = 0
+
+    def record_usage(self, usage: ProcessUsage) -> None:
+        self.process_usages.append(usage)
+        self.peak_rss_bytes = max(self.peak_rss_bytes, usage.max_rss_bytes)
+
+    def record_concurrent_usages(self, groups: List[List[ProcessUsage]]) -> None:
+        # Each group runs its processes one after the other, but the groups run at the same time
+        for usages in groups:
+            self.process_usages.extend(usages)
+        concurrent_peak = sum(max((usage.max_rss_bytes for usage in usages), default=0) for usages in groups)
+        self.peak_rss_bytes = max(self.peak_rss_bytes, concurrent_peak)
+
+    def record_phase(self, phase: str, start_time: float) -> None:
+        self.phase_times[phase] = (start_time, time.time())
+
+    @property
+    def phase_durations(self) -> Dict[str, float]:
+        return {phase: end_time - start_time for phase, (start_time, end_time) in self.phase_times.items()}
+
+
 def init_and_plan(directory: str, terraform_cmd: str = 'terraform', display_colors: bool = False,
-                  env_variables: Optional[Dict[str, str]] = None) -> Tuple[bool, TerraformPlan]:
+                  env_variables: Optional[Dict[str, str]] = None,
+                  stats: Optional[PlanRunStats] = None, parallelism: Optional[int] = None,
+                  plan_decoder: Optional[PlanDecoder] = None,
+                  provider_log_level: Optional[str] = None) -> Tuple[bool, TerraformPlan]:
     """
     Runs 'terraform init', 'terraform plan' and 'terraform show' in the specified directory.
     Returns a boolean indicating whether there was a difference and the JSON output of 'terraform show'.
+    With a `plan_decoder`, the JSON output is written to a file summarized by the pool, and a
+    `TerraformPlanSummary` is returned instead.
+    The duration of the `init`, `plan`, `show` and `parse` phases, whether `plan` succeeded, the number of API
+    throttling messages it printed and the resources used by the terraform processes are recorded in `stats` when
+    provided. With a `provider_log_level`, the throttling messages of the provider logs are counted too.
     """
     logger = logging.getLogger(__name__)
     color_flag = [] if display_colors else ['-no-color']
+    parallelism_flag = [f'-parallelism={parallelism}'] if parallelism is not None else []
 
     # Default environment variables
     if env_variables is None:
         env_variables = {}
 
-    # Update environment variables
-    os.environ.update(env_variables)
+    if stats is None:
+        stats = PlanRunStats()
 
+    # The directory and environment variables are passed to each command rather than set on this process, which runs
+    # the checks of other deployments at the same time
     try:
-        # Change to the specified directory
-        os.chdir(directory)
-
         # Run `terraform init`
         logger.info(f"Running `{terraform_cmd} init` in directory: {directory}")
-        result = subprocess.run([terraform_cmd, 'init', '-input=false'] + color_flag, capture_output=True, text=True)
+        start_time = time.time()
+        result, usage = run_with_usage([terraform_cmd, 'init', '-input=false'] + color_flag, cwd=directory,
+                                       env=env_variables)
+        stats.record_phase('init', start_time)
+        stats.record_usage(usage)
         if result.returncode != 0:
             logger.error(f"`{terraform_cmd} init` failed with output:\n{result.stderr}")
             raise ConsoleException(f"`{terraform_cmd} init` failed", str(result.stderr))
 
         # Run `terraform plan -out=tfplan`
         logger.info(f"Running `{terraform_cmd} plan -out=tfplan` in directory: {directory}")
-        result = subprocess.run([terraform_cmd, 'plan', '-out=tfplan', '-input=false'] + color_flag, capture_output=True, text=True)
+        start_time = time.time()
+        result, usage = run_with_usage([terraform_cmd, 'plan', '-out=tfplan', '-input=false'] + parallelism_flag +
+                                       color_flag, cwd=directory,
+                                       env={**env_variables, **get_provider_log_env(directory, provider_log_level)})
+        stats.record_phase('plan', start_time)
+        stats.record_usage(usage)
+        stats.throttling_events = count_throttling_events(result.stderr) + count_logged_throttling_events(directory)
+        stats.plan_succeeded = result.returncode == 0
+        stats.plan_mode = 'full'
         if result.returncode != 0:
             logger.error(f"`{terraform_cmd} plan` failed with output:\n{result.stderr}")
             raise ConsoleException(f"'{terraform_cmd} plan' failed", str(result.stderr))
 
         # Run `terraform show -json tfplan`
         logger.info(f"Running `{terraform_cmd} show -json tfplan` in directory: {directory}")
-        result = subprocess.run([terraform_cmd, 'show', '-json', 'tfplan'] + color_flag, capture_output=True, text=True)
+        start_time = time.time()
+        plan_json_path = os.path.join(directory, 'tfplan.json') if plan_decoder is not None else None
+        result, usage = run_with_usage([terraform_cmd, 'show', '-json', 'tfplan'] + color_flag, cwd=directory,
+                                       env=env_variables, stdout_path=plan_json_path)
+        stats.record_phase('show', start_time)
+        stats.record_usage(usage)
         if result.returncode != 0:
             logger.error(f"`{terraform_cmd} show` failed with output:\n{result.stderr}")
             raise ConsoleException(f"`{terraform_cmd} show` failed", str(result.stderr))
 
         # Parse the JSON output
-        plan = json.loads(result.stdout)
-        terraform_plan = TerraformPlan(plan)
+        start_time = time.time()
+        if plan_decoder is not None:
+            terraform_plan = plan_decoder.summarize([plan_json_path])
+        else:
+            terraform_plan = TerraformPlan(json.loads(result.stdout))
 
         # Check if the plan format is supported
         if terraform_plan.format_version != '1.2':
-            logger.error(f"Unsupported Terraform plan format version: {plan['format_version']}")
-            raise Exception(f"Unsupported Terraform plan format version: {plan['format_version']}")
+            logger.error(f"Unsupported Terraform plan format version: {terraform_plan.format_version}")
+            raise Exception(f"Unsupported Terraform plan format version: {terraform_plan.format_version}")
 
         # Check if there's a difference
         difference = terraform_plan.count_resources_except_noop_and_read() > 0
+        stats.record_phase('parse', start_time)
 
         logger.info(f"Difference in `{terraform_cmd} plan`: {difference}")
 
-        return difference, TerraformPlan(plan)
+        return difference, terraform_plan
 
     except Exception as e:
         logger.error(f"Error running terraform commands in directory {directory}: {str(e)}")
         raise
 
+
+
+def list_state_targets(directory: str, terraform_cmd: str = 'terraform', stats: Optional[PlanRunStats] = None,
+                       env_variables: Optional[Dict[str, str]] = None) -> Dict[str, int]:
+    """Lists the top-level targets of the resources in the state of an initialized directory."""
+    result, usage = run_with_usage([terraform_cmd, 'state', 'list'], cwd=directory, env=env_variables)
+    if stats is not None:
+        stats.record_usage(usage)
+    if result.returncode != 0:
+        raise ConsoleException(f"`{terraform_cmd} state list` failed", str(result.stderr))
+    return group_addresses_by_target(result.stdout.splitlines())
+
+
+def _plan_shard(shard_directory: str, targets: List[str], terraform_cmd: str, color_flag: List[str],
+                parallelism_flag: List[str], timeout: Optional[float], env_variables: Dict[str, str],
+                provider_log_level: Optional[str], cancel: threading.Event) -> Tuple[str, int, List[ProcessUsage]]:
+    # Plans are read-only, the state lock is skipped so that the shards do not wait on each other
+    target_flags = [f'-target={target}' for target in targets]
+    result, plan_usage = run_with_usage([terraform_cmd, 'plan', '-out=tfplan', '-input=false', '-lock=false'] +
+                                        target_flags + parallelism_flag + color_flag, cwd=shard_directory,
+                                        timeout=timeout, cancel=cancel,
+                                        env={**env_variables, **get_provider_log_env(shard_directory,
+                                                                                     provider_log_level)})
+    throttling_events = count_throttling_events(result.stderr) + count_logged_throttling_events(shard_directory)
+    if result.returncode != 0:
+        raise ConsoleException(f"`{terraform_cmd} plan` of shard failed", str(result.stderr))
+
+    plan_json_path = os.path.join(shard_directory, 'tfplan.json')
+    result, show_usage = run_with_usage([terraform_cmd, 'show', '-json', 'tfplan'] + color_flag, cwd=shard_directory,
+                                        timeout=timeout, env=env_variables, stdout_path=plan_json_path,
+                                        cancel=cancel)
+    if result.returncode != 0:
+        raise ConsoleException(f"`{terraform_cmd} show` of shard failed", str(result.stderr))
+    return plan_json_path, throttling_events, [plan_usage, show_usage]
+
+
+def _copy_for_shard(copy_root: str, directory: str, shard_root: str) -> str:
+    # The providers and modules installed by `init` are shared through a symlink instead of being copied
+    shutil.copytree(copy_root, shard_root, symlinks=True, ignore=shutil.ignore_patterns('.git', '.terraform'))
+    shard_directory = os.path.join(shard_root, os.path.relpath(directory, copy_root))
+    if os.path.isdir(os.path.join(directory, '.terraform')):
+        os.symlink(os.path.join(directory, '.terraform'), os.path.join(shard_directory, '.terraform'))
+    return shard_directory
+
+
+def sharded_init_and_plan(directory: str, shards: int, copy_root: Optional[str] = None,
+                          terraform_cmd: str = 'terraform', display_colors: bool = False,
+                          env_variables: Optional[Dict[str, str]] = None, stats: Optional[PlanRunStats] = None,
+                          parallelism: Optional[int] = None, previous_plan: Optional[TerraformPlan] = None,
+                          timeout: Optional[float] = None, plan_decoder: Optional[PlanDecoder] = None,
+                          provider_log_level: Optional[str] = None) -> Tuple[bool, TerraformPlan]:
+    """
+    Same as `init_and_plan`, but splits the top-level modules and root resources in `shards` groups planned
+    concurrently with `-target`, each in its own copy of `copy_root` (the directory holding `directory` and the local
+    modules it references, defaults to `directory`). The targets are taken from `previous_plan`, or from the state,
+    completed with the ones declared in the configuration.
+    `parallelism` is divided between the shards. With a `plan_decoder`, the shard plans are merged and
+    summarized by the pool.
+
+    Falls back to a full `init_and_plan` when a shard fails or takes longer than `timeout` seconds, the shards still
+    running are then killed.
+    """
+    logger = logging.getLogger(__name__)
+    color_flag = [] if display_colors else ['-no-color']
+    copy_root = copy_root if copy_root is not None else directory
+
+    if env_variables is None:
+        env_variables = {}
+
+    if stats is None:
+        stats = PlanRunStats()
+
+    def full_plan() -> Tuple[bool, TerraformPlan]:
+        return init_and_plan(directory, terraform_cmd=terraform_cmd, display_colors=display_colors,
+                             env_variables=env_variables, stats=stats, parallelism=parallelism,
+                             plan_decoder=plan_decoder, provider_log_level=provider_log_level)
+
+    logger.info(f"Running `{terraform_cmd} init` in directory: {directory}")
+    start_time = time.time()
+    result, usage = run_with_usage([terraform_cmd, 'init', '-input=false'] + color_flag, cwd=directory,
+                                   env=env_variables)
+    stats.record_phase('init', start_time)
+    stats.record_usage(usage)
+    if result.returncode != 0:
+        logger.error(f"`{terraform_cmd} init` failed with output:\n{result.stderr}")
+        raise ConsoleException(f"`{terraform_cmd} init` failed", str(result.stderr))
+
+    targets = dict(previous_plan.get_top_level_targets()) if previous_plan is not None else {}
+    if not targets:
+        try:
+            targets = list_state_targets(directory, terraform_cmd=terraform_cmd, stats=stats,
+                                         env_variables=env_variables)
+        except ConsoleException as e:
+            logger.warning(f"Unable to list the state targets, running a full plan: {e}")
+            return full_plan()
+
+    # Neither the previous plan nor the state know about the modules and resources added to the code since then
+    try:
+        for target, count in list_configuration_targets(directory).items():
+            targets.setdefault(target, count)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unable to list the configuration targets, running a full plan: {e}")
+        return full_plan()
+
+    shard_targets = split_into_shards(targets, shards)
+    if len(shard_targets) < 2:
+        logger.info(f"Not enough targets to shard the plan in directory {directory}, running a full plan")
+        return full_plan()
+
+    shard_parallelism = max(1, parallelism // len(shard_targets)) if parallelism is not None else None
+    parallelism_flag = [f'-parallelism={shard_parallelism}'] if shard_parallelism is not None else []
+
+    shards_root = tempfile.mkdtemp()
+    try:
+        logger.info(f"Running `{terraform_cmd} plan` in {len(shard_targets)} shards in directory: {directory}")
+        start_time = time.time()
+        cancel = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(shard_targets)) as executor:
+            futures = []
+            try:
+                for i, shard in enumerate(shard_targets):
+                    shard_directory = _copy_for_shard(copy_root, directory, os.path.join(shards_root, str(i)))
+                    futures.append(executor.submit(_plan_shard, shard_directory, shard, terraform_cmd, color_flag,
+                                                   parallelism_flag, timeout, env_variables, provider_log_level,
+                                                   cancel))
+                # Results are collected as the shards complete, so that the first failure stops the others right away
+                shard_results = [future.result() for future in as_completed(futures)]
+            except (ConsoleException, subprocess.TimeoutExpired, OSError) as e:
+                logger.warning(f"A shard of the plan failed, running a full plan instead: {e}")
+                shard_results = None
+            finally:
+                # Whatever the error, the shards still running are stopped, the pool would otherwise wait for them
+                cancel.set()
+                for future in futures:
+                    future.cancel()
+        stats.record_phase('plan', start_time)
+
+        if shard_results is None:
+            terraform_plan = None
+        else:
+            stats.throttling_events = sum(throttling_events for _, throttling_events, _ in shard_results)
+            stats.plan_succeeded = True
+            stats.plan_mode = 'sharded'
+            stats.record_concurrent_usages([usages for _, _, usages in shard_results])
+
+            start_time = time.time()
+            plan_json_paths = [plan_json_path for plan_json_path, _, _ in shard_results]
+            if plan_decoder is not None:
+                terraform_plan = plan_decoder.summarize(plan_json_paths)
+            else:
+                plans = []
+                for plan_json_path in plan_json_paths:
+                    with open(plan_json_path, 'r') as file:
+                        plans.append(json.load(file))
+                terraform_plan = TerraformPlan(merge_plans(plans))
+    finally:
+        shutil.rmtree(shards_root, ignore_errors=True)
+
+    if terraform_plan is None:
+        return full_plan()
+
+    if terraform_plan.format_version != '1.2':
+        logger.error(f"Unsupported Terraform plan format version: {terraform_plan.format_version}")
+        raise Exception(f"Unsupported Terraform plan format version: {terraform_plan.format_version}")
+
+    difference = terraform_plan.count_resources_except_noop_and_read() > 0
+    stats.record_phase('parse', start_time)
+
+    logger.info(f"Difference in sharded `{terraform_cmd} plan`: {difference}")
+
+    return difference, terraform_plan
@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+
+class Span:
+    """
+    A single timed operation, modeled after the OpenTelemetry span data model.
+    https://opentelemetry.io/docs/specs/otel/trace/api/#span
+    """
+
+    def __init__(self, name: str, trace_id: str, parent_span_id: Optional[str] = None,
+                 attributes: Optional[Dict[str, Any]] = None) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.attributes = attributes if attributes is not None else {}
+        self.status = "OK"
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano: Optional[int] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_error(self, error: BaseException) -> None:
+        self.status = "ERROR"
+        self.attributes["exception.type"] = type(error).__name__
+        self.attributes["exception.message"] = str(error)
+
+    def end(self) -> None:
+        self.end_time_unix_nano = time.time_ns()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_time_unix_nano,
+            "endTimeUnixNano": self.end_time_unix_nano,
+            "attributes": self.attributes,
+            "status": self.status,
+        }
+
+
+class FileSpanExporter:
+    """Appends finished spans to a file, one JSON document per line."""
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            with open(self.file_path, "a") as file:
+                file.write(line + "\n")
+
+
+class Tracer:
+    """
+    Creates spans and hands them to the exporter once they end. A tracer without an exporter is a no-op, so the
+    instrumented code does not need to check whether tracing is enabled.
+    """
+
+    def __init__(self, exporter: Optional[FileSpanExporter] = None) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.exporter = exporter
+
+    @contextmanager
+    def start_span(self, name: str, parent: Optional[Span] = None,
+                   attributes: Optional[Dict[str, Any]] = None) -> Iterator[Span]:
+        trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        span = Span(name, trace_id, parent_span_id=parent.span_id if parent is not None else None,
+                    attributes=attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            span.end()
+            self._export(span)
+
+    def record_span(self, name: str, start_time: float, end_time: float, parent: Optional[Span] = None,
+                    attributes: Optional[Dict[str, Any]] = None) -> None:
+        """Records a span for an operation that already completed, timed by the caller in seconds since the epoch."""
+        trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        span = Span(name, trace_id, parent_span_id=parent.span_id if parent is not None else None,
+                    attributes=attributes)
+        span.start_time_unix_nano = int(start_time * 1e9)
+        span.end_time_unix_nano = int(end_time * 1e9)
+        self._export(span)
+
+    def _export(self, span: Span) -> None:
+        if self.exporter is None:
+            return
+        try:
+            self.exporter.export(span)
+        except OSError as e:
+            self.logger.warning(f"Unable to export span \"{span.name}\": {e}")